@@ -6,34 +6,161 @@ Converts EPUB files into chapter-wise markdown files by parsing the EPUB structu
 and extracting content from each chapter.
 
 Requirements:
-    pip install ebooklib beautifulsoup4 markdownify
+    pip install ebooklib beautifulsoup4 lxml markdownify
 
 Usage:
     python epub_to_markdown.py path/to/book.epub
 """
 
 import argparse
+import concurrent.futures
+import functools
+import os
 import re
+import warnings
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Tuple, Optional
 import zipfile
 
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+import lxml.html
+from lxml.etree import ParserError
+from bs4 import BeautifulSoup, FeatureNotFound, ParserRejectedMarkup, XMLParsedAsHTMLWarning
+from markdownify import MarkdownConverter
+
+# EPUB chapters are XHTML; parsing them as HTML is intentional
+warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+_BAD_CHARS_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+_MULTINEWLINE_RE = re.compile(r'\n{3,}')
+
+_TITLE_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+_MD_CONVERTER = MarkdownConverter(heading_style="ATX", bullets="-")
+
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+
+
+def parse_html(html_content) -> BeautifulSoup:
+    """Parse HTML with lxml, falling back to html.parser if lxml rejects it.
+
+    Accepts bytes or str; bytes are decoded by the parser using the
+    document's declared encoding.
+    """
+    try:
+        return BeautifulSoup(html_content, 'lxml')
+    except (FeatureNotFound, ParserRejectedMarkup):
+        return BeautifulSoup(html_content, 'html.parser')
+
+
+@dataclass
+class Chapters:
+    """Processed chapters stored as parallel lists, one entry per chapter."""
+    titles: List[str] = field(default_factory=list)
+    clean_titles: List[str] = field(default_factory=list)
+    contents: List[str] = field(default_factory=list)
+    
+    def __len__(self) -> int:
+        return len(self.titles)
+    
+    def append(self, title: str, clean_title: str, content: str):
+        self.titles.append(title)
+        self.clean_titles.append(clean_title)
+        self.contents.append(content)
+
+
+@functools.lru_cache(maxsize=4096)
+def clean_filename(title: str) -> str:
+    """Clean title to create a valid filename."""
+    # Remove HTML tags if any
+    title = _HTML_TAG_RE.sub('', title)
+    # Replace problematic characters
+    title = title.translate(_BAD_CHARS_TABLE)
+    # Remove extra whitespace
+    title = ' '.join(title.split())
+    # Limit length
+    return title[:100] if len(title) > 100 else title
+
+
+def is_chapter_heading(text: str) -> bool:
+    """Check whether text starts like "Chapter 1", "Ch 1" or "Ch. 1"."""
+    head = text[:7].lower()
+    if head == 'chapter':
+        rest = text[7:]
+    elif head.startswith('ch.'):
+        rest = text[3:]
+    elif head.startswith('ch'):
+        rest = text[2:]
+    else:
+        return False
+    # Require at least one whitespace character before the number
+    number = rest.lstrip()
+    return len(number) < len(rest) and number[:1].isdecimal()
+
+
+def text_length(soup: BeautifulSoup, limit: int) -> int:
+    """Count stripped text characters in soup, stopping once limit is reached."""
+    total = 0
+    for text in soup.stripped_strings:
+        total += len(text)
+        if total >= limit:
+            break
+    return total
+
+
+def write_chunks(fd: int, chunks: List[bytes]):
+    """Write every chunk to a raw file descriptor, retrying partial writes."""
+    for chunk in chunks:
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+class SkipChapter(Exception):
+    """Raised when a spine item does not look like a chapter."""
+
+
+def process_chapter_content(content) -> Tuple[str, str]:
+    """Convert one spine item's HTML into a (title, markdown) tuple.
+
+    Runs in a worker process, so it only touches its arguments.
+    """
+    # Extract title
+    title = EPUBProcessor.extract_title_from_content(content)
+    
+    soup = parse_html(content)
+    
+    # Skip if content is too short (likely not a chapter)
+    length = text_length(soup, 100)
+    if length < 100:
+        raise SkipChapter(f"too short ({length} chars)")
+    
+    # Convert to markdown
+    markdown_content = EPUBProcessor.html_to_markdown(soup)
+    
+    if not markdown_content.strip():
+        raise SkipChapter("no content after conversion")
+    
+    return title, markdown_content
 
 
 class EPUBProcessor:
     def __init__(self, epub_path: Path):
         self.epub_path = Path(epub_path)
         self.book = None
+        self.items = []
         self.output_dir = self.epub_path.parent / f"{self.epub_path.stem}_chapters"
         
     def load_epub(self):
         """Load the EPUB file."""
         try:
             self.book = epub.read_epub(str(self.epub_path))
+            self.items = list(self.book.get_items())
+            # Drop metadata cached before this book was loaded
+            self.__dict__.pop('book_info', None)
             print(f"✓ Loaded EPUB: {self.book.get_metadata('DC', 'title')[0][0]}")
         except Exception as e:
             raise Exception(f"Failed to load EPUB file: {e}")
@@ -41,137 +168,127 @@ class EPUBProcessor:
     def get_spine_items(self) -> List[epub.EpubHtml]:
         """Get all HTML items from the book's spine (reading order)."""
         spine_items = []
+        items_by_id = {item.get_id(): item for item in self.items}
         for item_id, _ in self.book.spine:
-            # Find item by ID in the book's items
-            item = None
-            for book_item in self.book.get_items():
-                if book_item.get_id() == item_id:
-                    item = book_item
-                    break
-            
+            item = items_by_id.get(item_id)
             if item and isinstance(item, epub.EpubHtml):
                 spine_items.append(item)
         return spine_items
     
     def clean_filename(self, title: str) -> str:
         """Clean title to create a valid filename."""
-        # Remove HTML tags if any
-        title = re.sub(r'<[^>]+>', '', title)
-        # Replace problematic characters
-        title = re.sub(r'[<>:"/\\|?*]', '_', title)
-        # Remove extra whitespace
-        title = re.sub(r'\s+', ' ', title).strip()
-        # Limit length
-        return title[:100] if len(title) > 100 else title
+        return clean_filename(title)
     
-    def extract_title_from_content(self, soup: BeautifulSoup) -> str:
-        """Extract chapter title from HTML content."""
+    @staticmethod
+    def extract_title_from_content(content) -> str:
+        """Extract chapter title from raw HTML content.
+
+        Uses lxml directly; its C tree lookups are much cheaper than
+        BeautifulSoup's pure-Python find/find_all walks.
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        try:
+            root = lxml.html.document_fromstring(content, parser=_TITLE_PARSER)
+        except ParserError:
+            return "Untitled Chapter"
+        
         # Try different heading tags
         for tag in ['h1', 'h2', 'h3', 'title']:
-            element = soup.find(tag)
-            if element and element.get_text().strip():
-                return element.get_text().strip()
+            element = next(root.iter(tag), None)
+            if element is not None and element.text_content().strip():
+                return element.text_content().strip()
         
         # Fallback: look for any element with common chapter indicators
-        for element in soup.find_all(['p', 'div', 'span']):
-            text = element.get_text().strip()
-            if re.match(r'^(chapter|ch\.?)\s+\d+', text.lower()):
+        for element in root.iter('p', 'div', 'span'):
+            text = element.text_content().strip()
+            if is_chapter_heading(text):
                 return text
         
         return "Untitled Chapter"
     
-    def html_to_markdown(self, html_content: str) -> str:
-        """Convert HTML content to Markdown."""
-        # Parse HTML
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Remove script and style elements
-        for element in soup(['script', 'style', 'meta', 'link']):
-            element.decompose()
-        
-        # Convert to markdown
-        markdown_content = md(
-            str(soup),
-            heading_style="ATX",
-            bullets="-",
-            strip=['script', 'style']
-        )
+    @staticmethod
+    def html_to_markdown(soup: BeautifulSoup) -> str:
+        """Convert parsed HTML content to Markdown."""
+        # Convert the already-parsed tree to markdown. Script and style
+        # elements render as empty strings and meta/link carry no text, so
+        # they drop out during conversion without a separate removal pass.
+        markdown_content = _MD_CONVERTER.convert_soup(soup)
         
         # Clean up excessive newlines
-        markdown_content = re.sub(r'\n{3,}', '\n\n', markdown_content)
+        markdown_content = _MULTINEWLINE_RE.sub('\n\n', markdown_content)
         
         return markdown_content.strip()
     
-    def process_chapters(self) -> List[Tuple[str, str]]:
-        """Process all chapters and return list of (title, content) tuples."""
+    def process_chapters(self) -> Chapters:
+        """Process all chapters and return their titles, filenames and content."""
         spine_items = self.get_spine_items()
-        chapters = []
+        chapters = Chapters()
         
         print(f"Found {len(spine_items)} items in spine")
         
-        for i, item in enumerate(spine_items, 1):
-            try:
-                # Get HTML content - handle both string and bytes
-                content = item.get_content()
-                if isinstance(content, bytes):
-                    html_content = content.decode('utf-8')
-                else:
-                    html_content = content
-                
-                soup = BeautifulSoup(html_content, 'html.parser')
-                
-                # Extract title
-                title = self.extract_title_from_content(soup)
-                
-                # Skip if content is too short (likely not a chapter)
-                text_content = soup.get_text().strip()
-                if len(text_content) < 100:
-                    print(f"  Skipping item {i}: too short ({len(text_content)} chars)")
+        # Chapters are independent and CPU-bound, so convert them in parallel
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            futures = [
+                executor.submit(process_chapter_content, item.get_content())
+                for item in spine_items
+            ]
+            
+            for i, future in enumerate(futures, 1):
+                try:
+                    title, markdown_content = future.result()
+                except SkipChapter as e:
+                    print(f"  Skipping item {i}: {e}")
                     continue
-                
-                # Convert to markdown
-                markdown_content = self.html_to_markdown(html_content)
-                
-                if not markdown_content.strip():
-                    print(f"  Skipping item {i}: no content after conversion")
+                except Exception as e:
+                    print(f"  ✗ Error processing item {i}: {e}")
                     continue
                 
-                chapters.append((title, markdown_content))
+                chapters.append(title, self.clean_filename(title), markdown_content)
                 print(f"  ✓ Processed: {title}")
-                
-            except Exception as e:
-                print(f"  ✗ Error processing item {i}: {e}")
-                continue
         
         return chapters
     
-    def save_chapters(self, chapters: List[Tuple[str, str]]):
+    def save_chapters(self, chapters: Chapters):
         """Save chapters as individual markdown files."""
         # Create output directory
         self.output_dir.mkdir(exist_ok=True)
         print(f"\nSaving chapters to: {self.output_dir}")
         
-        # Save each chapter
-        for i, (title, content) in enumerate(chapters, 1):
-            # Create filename
-            clean_title = self.clean_filename(title)
-            filename = f"{i:02d}_{clean_title}.md"
-            filepath = self.output_dir / filename
-            
-            # Prepare content with title header
-            full_content = f"# {title}\n\n{content}"
-            
-            # Write file
-            try:
-                filepath.write_text(full_content, encoding='utf-8')
-                print(f"  ✓ Saved: {filename}")
-            except Exception as e:
-                print(f"  ✗ Error saving {filename}: {e}")
+        # Open files relative to the output directory where supported, so
+        # each chapter skips resolving the full path again
+        dir_fd = None
+        if os.open in os.supports_dir_fd:
+            dir_fd = os.open(self.output_dir, os.O_RDONLY)
+        
+        try:
+            # Save each chapter
+            for i, (title, clean_title, content) in enumerate(
+                zip(chapters.titles, chapters.clean_titles, chapters.contents), 1
+            ):
+                # Create filename
+                filename = f"{i:02d}_{clean_title}.md"
+                filepath = filename if dir_fd is not None else self.output_dir / filename
+                
+                # Write title header and content without joining them first
+                try:
+                    fd = os.open(filepath, _WRITE_FLAGS, 0o644, dir_fd=dir_fd)
+                    try:
+                        write_chunks(fd, [f"# {title}\n\n".encode('utf-8'), content.encode('utf-8')])
+                    finally:
+                        os.close(fd)
+                    print(f"  ✓ Saved: {filename}")
+                except Exception as e:
+                    print(f"  ✗ Error saving {filename}: {e}")
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
         
         print(f"\n✓ Completed! {len(chapters)} chapters saved to {self.output_dir}")
     
-    def get_book_info(self) -> dict:
-        """Extract book metadata."""
+    @functools.cached_property
+    def book_info(self) -> dict:
+        """Book metadata, extracted once per loaded book."""
         if not self.book:
             return {}
         
@@ -193,11 +310,11 @@ class EPUBProcessor:
         
         return info
     
-    def create_index_file(self, chapters: List[Tuple[str, str]]):
+    def create_index_file(self, chapters: Chapters):
         """Create an index file with book info and chapter list."""
-        info = self.get_book_info()
+        info = self.book_info
         
-        index_content = f"""# {info['title']}
+        header = f"""# {info['title']}
 
 **Author:** {info['author']}  
 **Language:** {info['language']}  
@@ -207,13 +324,13 @@ class EPUBProcessor:
 
 """
         
-        for i, (title, _) in enumerate(chapters, 1):
-            clean_title = self.clean_filename(title)
+        lines = [header]
+        for i, (title, clean_title) in enumerate(zip(chapters.titles, chapters.clean_titles), 1):
             filename = f"{i:02d}_{clean_title}.md"
-            index_content += f"{i}. [{title}](./{filename})\n"
+            lines.append(f"{i}. [{title}](./{filename})\n")
         
         index_path = self.output_dir / "README.md"
-        index_path.write_text(index_content, encoding='utf-8')
+        index_path.write_bytes(''.join(lines).encode('utf-8'))
         print(f"  ✓ Created index: README.md")
     
     def process(self):